@@ -0,0 +1,85 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing, contextmanager
+from typing import Optional, Dict, Any
+
+from helpers import canonical_id
+
+
+store_path = os.environ.get('ARTIST_CACHE_FILE') or os.path.join(
+    os.path.dirname(os.environ.get('CACHE_FILE') or ''), 'artists.sqlite')
+# Stored payloads are rebuilt at least this often, even if the fingerprint did not change
+max_age = int(os.environ.get('ARTIST_CACHE_MAX_AGE', 60 * 60 * 24 * 30))
+
+_lock = threading.Lock()
+
+
+@contextmanager
+def _connect():
+    with _lock, closing(sqlite3.connect(store_path, timeout=30)) as connection, connection:
+        connection.execute("""CREATE TABLE IF NOT EXISTS artists (
+            id TEXT PRIMARY KEY, fingerprint TEXT, payload TEXT, album_ids TEXT, updated REAL)""")
+        connection.execute("""CREATE TABLE IF NOT EXISTS albums (
+            id TEXT PRIMARY KEY, payload TEXT, updated REAL)""")
+        yield connection
+
+
+def load_artist(artist_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Loads the stored fingerprint and Lidarr payload of an artist.
+
+    Args:
+    artist_id: The Tidal artist ID.
+
+    Returns:
+    A dictionary with "fingerprint", "payload" and "album_ids", or None if
+    nothing (recent enough) is stored.
+    """
+    with _connect() as connection:
+        row = connection.execute("SELECT fingerprint, payload, album_ids, updated FROM artists WHERE id = ?",
+                                 (canonical_id(artist_id),)).fetchone()
+    if row is None or row[3] < time.time() - max_age:
+        return None
+    return {"fingerprint": json.loads(row[0]), "payload": json.loads(row[1]), "album_ids": json.loads(row[2])}
+
+
+def save_artist(artist_id: str, fingerprint: dict, payload: dict, album_ids: list) -> None:
+    """Stores the fingerprint and Lidarr payload of an artist."""
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO artists VALUES (?, ?, ?, ?, ?)",
+                           (canonical_id(artist_id), json.dumps(fingerprint), json.dumps(payload),
+                            json.dumps(album_ids), time.time()))
+
+
+def load_album(album_id: str) -> Optional[Dict[str, Any]]:
+    """Loads the stored Lidarr payload of an album, or None if nothing (recent enough) is stored."""
+    with _connect() as connection:
+        row = connection.execute("SELECT payload, updated FROM albums WHERE id = ?",
+                                 (canonical_id(album_id),)).fetchone()
+    if row is None or row[1] < time.time() - max_age:
+        return None
+    return json.loads(row[0])
+
+
+def save_album(album_id: str, payload: dict) -> None:
+    """Stores the Lidarr payload of an album."""
+    with _connect() as connection:
+        connection.execute("INSERT OR REPLACE INTO albums VALUES (?, ?, ?)",
+                           (canonical_id(album_id), json.dumps(payload), time.time()))
+
+
+def forget_albums(album_ids: list) -> int:
+    """Removes stored album payloads, so they are fetched from Tidal again. Returns how many were removed."""
+    with _connect() as connection:
+        cursor = connection.executemany("DELETE FROM albums WHERE id = ?", [(canonical_id(i),) for i in album_ids])
+        return cursor.rowcount
+
+
+def store_status() -> dict:
+    with _connect() as connection:
+        artists = connection.execute("SELECT COUNT(*) FROM artists").fetchone()[0]
+        albums = connection.execute("SELECT COUNT(*) FROM albums").fetchone()[0]
+    return {"artists": artists, "albums": albums, "max_age": max_age}
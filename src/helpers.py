@@ -48,6 +48,20 @@ def fake_id(id: any, type: str) -> str:
   return f"{prefix * 8}-{prefix * 4}-{prefix * 4}-{prefix * 4}-{id_str}"
 
 
+def canonical_id(id: any) -> str:
+  """
+  Converts a Tidal ID to one form, whether it comes zero-padded from a fake ID
+  ("000000000501") or as an integer from Tidal (501).
+
+  Args:
+    id: The Tidal ID.
+
+  Returns:
+    The ID as a string without leading zeros.
+  """
+  return str(id).lstrip("0") or "0"
+
+
 def get_type(rc: str) -> str:
     type = rc.lower()
     if type == "ep":
@@ -1,7 +1,17 @@
 """Redirect HTTP requests to another server."""
 
+import json
+import os
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
 from mitmproxy import http
 
+# When set, redirected requests are recorded there (one JSON object per line), to be replayed with src/replay.py
+capture_path = os.environ.get('CAPTURE_FILE')
+# Query parameters that are credentials, their values are never written to the capture
+secret_params = {'api_key', 'apikey', 'api_sig', 'sk', 'token', 'password', 'sessionid'}
+
 
 def request(flow: http.HTTPFlow) -> None:
     # pretty_host takes the "Host" header of the request into account,
@@ -12,6 +22,45 @@ def request(flow: http.HTTPFlow) -> None:
     elif flow.request.pretty_host == "api.musicinfo.pro" or flow.request.pretty_host == "ws.audioscrobbler.com":
         print("flow")
         flow.request.headers["X-Proxy-Host"] = flow.request.pretty_host
+        flow.metadata["redirected_from"] = flow.request.pretty_host
         flow.request.scheme = "http"
         flow.request.host = "127.0.0.1"
         flow.request.port = 7171
+
+
+def response(flow: http.HTTPFlow) -> None:
+    capture(flow, flow.response.status_code, flow.response.timestamp_end)
+
+
+def error(flow: http.HTTPFlow) -> None:
+    capture(flow, None, time.time())
+
+
+def capture(flow: http.HTTPFlow, status, timestamp_end) -> None:
+    """Appends a redirected request, without headers or credentials, to the capture file."""
+    if not capture_path or "redirected_from" not in flow.metadata:
+        return
+
+    url = urlsplit(flow.request.path)
+    entry = {
+        # Absolute, so captures appended by several runs of mitmproxy keep their order
+        "t": round(flow.request.timestamp_start, 3),
+        "method": flow.request.method,
+        "host": flow.metadata["redirected_from"],
+        "path": urlunsplit(("", "", url.path, redact(url.query), "")),
+        "status": status,
+        "ms": round((timestamp_end - flow.request.timestamp_start) * 1000, 1) if timestamp_end else None,
+    }
+    if flow.request.content:
+        body = flow.request.get_text(strict=False)
+        if "application/x-www-form-urlencoded" in flow.request.headers.get("content-type", ""):
+            body = redact(body)
+        entry["body"] = body
+
+    with open(capture_path, 'a') as f:
+        f.write(json.dumps(entry, separators=(',', ':')) + "\n")
+
+
+def redact(query: str) -> str:
+    params = parse_qsl(query, keep_blank_values=True)
+    return urlencode([(k, 'REDACTED' if k.lower() in secret_params else v) for k, v in params])
@@ -7,8 +7,10 @@ from tidal import (
     get_album,
     tidal_artist,
     get_artist_by_name,
+    failure_status,
+    tidal_status,
 )
-from helpers import remove_keys
+from helpers import remove_keys, canonical_id
 
 app = Flask(__name__)
 
@@ -25,6 +27,8 @@ def proxy(path):
         return do_scrobbler(request)
     if path == "ping":
         return jsonify("pong"), 200
+    if path == "status":
+        return jsonify(tidal_status()), 200
 
     return do_api(request, path)
 
@@ -72,24 +76,24 @@ def do_api(req, path):
 
     elif "/v0.4/artist/" in url or "/v1/artist/" in url:
         if "-aaaa-" in path:
-            artist_id = path.split("/")[-1].split("-")[-1].replace("a", "")
+            artist_id = canonical_id(path.split("/")[-1].split("-")[-1].replace("a", ""))
             lidarr_data = tidal_artist(artist_id)
-            status_code = 200 if lidarr_data is not None else 404
+            status_code = 200 if lidarr_data is not None else failure_status("artist", artist_id)
         else:
             # This is added to make the service work with existing artists in
             # lidarr that use MBID.
             lidarr_data = get_artist_by_name(lidarr_data['artistname'])
-            # Set old ID here (MBID)
-            lidarr_data['oldids'] = [lidarr_data['id']]
+            if lidarr_data is not None:
+                # Set old ID here (MBID)
+                lidarr_data['oldids'] = [lidarr_data['id']]
             status_code = 200 if lidarr_data is not None else 404
         return jsonify(lidarr_data), status_code
 
     elif "/v0.4/album/" in url or "/v1/album/" in url:
         if "-bbbb-" in path:
-            album_id = path.split("/")[-1].split("-")[-1].replace("b", "")
+            album_id = canonical_id(path.split("/")[-1].split("-")[-1].replace("b", ""))
             lidarr_data = get_album(album_id)
-            # 502 because the album definitely exists, might be running into rate limit
-            status_code = 200 if lidarr_data is not None else 502
+            status_code = 200 if lidarr_data is not None else failure_status("album", album_id)
         return jsonify(lidarr_data), status_code
 
     # Passthrough to Lidarr api (for example for Charts and Series)
@@ -1,10 +1,20 @@
 import requests
 from typing import Optional, Dict, Any
 import os
+import threading
+import time
 
-from helpers import normalize
+from matching import NameIndex, best_match
 
 lidarr_api_url = "https://api.musicinfo.pro"
+# How long (in seconds) the index of artists in the Lidarr library is reused
+library_index_ttl = int(os.environ.get('LIDARR_INDEX_TTL', 60 * 5))
+# Minimum time (in seconds) between rebuilds requested because an artist was not found
+library_index_min_age = 30
+
+_library_index = None
+_library_index_built = 0.0
+_library_index_lock = threading.Lock()
 
 
 def get_lidarr_artist(name: str) -> Optional[Dict[str, Any]]:
@@ -22,10 +32,9 @@ def get_lidarr_artist(name: str) -> Optional[Dict[str, Any]]:
     response.raise_for_status()  # Raise exception for non-2xx status codes
     json_data = response.json()
 
-    artist = next((item for item in json_data
-                   if item.get("album") is None
-                   and item.get("artist") is not None
-                   and normalize(item["artist"]["artistname"]) == normalize(name)), None)
+    artist = best_match(name,
+                        [item for item in json_data if item.get("album") is None and item.get("artist") is not None],
+                        key=lambda item: item["artist"]["artistname"])
 
     return artist.get("artist") if artist else None
 
@@ -42,3 +51,32 @@ def get_all_lidarr_artists() -> list[Dict[str, Any]]:
   with requests.get(url, headers=headers) as response:
     response.raise_for_status()
     return response.json()
+
+
+def get_lidarr_library_index(refresh: bool = False) -> NameIndex:
+  """
+  Returns an index of all artists in the Lidarr library by name.
+
+  The index is rebuilt every LIDARR_INDEX_TTL seconds. If Lidarr can't be
+  reached, the previous index is kept.
+
+  Args:
+      refresh: Rebuild the index now, e.g. because an artist was just added to
+          Lidarr. Ignored if the index is less than 30 seconds old.
+
+  Returns:
+      A NameIndex of artist dictionaries, keyed by "artistName".
+  """
+  global _library_index, _library_index_built
+  with _library_index_lock:
+    age = time.monotonic() - _library_index_built
+    if _library_index is None or age > library_index_ttl or (refresh and age > library_index_min_age):
+      try:
+        _library_index = NameIndex(get_all_lidarr_artists(), key=lambda a: a["artistName"])
+        _library_index_built = time.monotonic()
+        print(f"Indexed {len(_library_index)} artists from the Lidarr library")
+      except requests.exceptions.RequestException as e:
+        if _library_index is None:
+          raise
+        print(f"Error refreshing Lidarr library index, keeping the previous one: {e}")
+    return _library_index
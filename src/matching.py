@@ -0,0 +1,103 @@
+import re
+from difflib import SequenceMatcher
+from functools import lru_cache
+from typing import Callable, Iterable, Optional, Any
+
+from helpers import normalize
+
+
+# Scores sent to Lidarr, from the strongest kind of match to the weakest
+EXACT = 100
+NORMALIZED = 95  # Same name ignoring case and accents
+TOKENS = 90  # Same words ignoring punctuation, e.g. "Guns N' Roses" and "Guns N Roses"
+FUZZY = 85  # Upper bound of the token overlap similarity
+
+
+@lru_cache(maxsize=65536)
+def normalized(text: str) -> str:
+    """Memoized version of helpers.normalize, with whitespace collapsed."""
+    return " ".join(normalize(text).split())
+
+
+@lru_cache(maxsize=65536)
+def tokens(text: str) -> tuple:
+    """Splits a name into its normalized words, dropping punctuation."""
+    return tuple(re.findall(r"[a-z0-9]+", normalized(text)))
+
+
+def score(query: str, name: str) -> int:
+    """
+    Scores how well a name matches a query.
+
+    Args:
+    query: The name that is searched for.
+    name: The candidate name.
+
+    Returns:
+    EXACT, NORMALIZED or TOKENS for equal names, otherwise a similarity
+    between 0 and FUZZY based on the overlap of their words.
+    """
+    if query == name:
+        return EXACT
+    # Names in non-latin scripts normalize to an empty string, don't let them match each other
+    if normalized(query) and normalized(query) == normalized(name):
+        return NORMALIZED
+    query_tokens, name_tokens = tokens(query), tokens(name)
+    if query_tokens and query_tokens == name_tokens:
+        return TOKENS
+    if not query_tokens or not name_tokens:
+        return 0
+
+    overlap = 2 * len(set(query_tokens) & set(name_tokens)) / (len(set(query_tokens)) + len(set(name_tokens)))
+    ratio = SequenceMatcher(None, normalized(query), normalized(name)).ratio()
+    return round(FUZZY * (0.7 * overlap + 0.3 * ratio))
+
+
+def same_name(a: str, b: str) -> bool:
+    """Returns True if both names refer to the same artist/album, ignoring case, accents and punctuation."""
+    return score(a, b) >= TOKENS
+
+
+def rank(query: str, candidates: Iterable[Any], key: Callable[[Any], str]) -> list:
+    """
+    Scores all candidates against a query in one pass.
+
+    Returns:
+    A list of (score, candidate) tuples, best match first. Candidates with
+    equal scores keep their original order.
+    """
+    scored = [(score(query, key(c)), c) for c in candidates]
+    scored.sort(key=lambda s: s[0], reverse=True)
+    return scored
+
+
+def best_match(query: str, candidates: Iterable[Any], key: Callable[[Any], str], threshold: int = TOKENS) -> Optional[Any]:
+    """Returns the best scoring candidate, or None if no candidate scores at least `threshold`."""
+    ranked = rank(query, candidates, key)
+    if ranked and ranked[0][0] >= threshold:
+        return ranked[0][1]
+    return None
+
+
+class NameIndex:
+    """Looks up items by name (exact first, then ignoring case, accents and punctuation) in constant time."""
+
+    def __init__(self, items: Iterable[Any], key: Callable[[Any], str]):
+        self._exact = {}
+        self._tokens = {}
+        for item in items:
+            name = key(item)
+            self._exact.setdefault(name, item)
+            if tokens(name):
+                self._tokens.setdefault(tokens(name), item)
+
+    def __len__(self):
+        return len(self._exact)
+
+    def lookup(self, name: str) -> Optional[Any]:
+        if name in self._exact:
+            return self._exact[name]
+        name_tokens = tokens(name)
+        if not name_tokens:
+            return None
+        return self._tokens.get(name_tokens)
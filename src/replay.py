@@ -0,0 +1,293 @@
+"""
+Replay a capture recorded by http-redirect-request.py against the Flask service.
+
+Lidarr's api (api.musicinfo.pro), the Lidarr library and Last.fm are served
+by a local stub server, and Tidal sessions are replaced by an in-process stub
+that generates artists/albums from their IDs and counts the calls made to it.
+No real service is contacted and no session file or cache is touched.
+
+Usage:
+    python src/replay.py capture.jsonl [--speed 1|10|max] [--concurrency 8]
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+############################################
+## Stub upstreams
+############################################
+
+calls = threading.local()
+
+
+def count_call():
+    calls.count = getattr(calls, "count", 0) + 1
+
+
+def stub_name(id) -> str:
+    return f"Artist {id}"
+
+
+class StubTrack:
+    def __init__(self, id, volume_num):
+        self.id = id
+        self.name = f"Track {id}"
+        self.duration = 180 + id % 120
+        self.volume_num = volume_num
+
+
+class StubAlbum:
+    def __init__(self, id):
+        self.id = int(id)
+        self.name = f"Album {self.id}"
+        self.type = ["ALBUM", "EP", "SINGLE"][self.id % 3]
+        self.popularity = self.id % 100
+        self.version = None
+        self.audio_modes = ["STEREO"]
+        self.media_metadata_tags = ["LOSSLESS"]
+        self.release_date = datetime(2000, 1, 1) + timedelta(days=self.id % 9000)
+        self.copyright = "Stub Records"
+        self.num_tracks = 1 + self.id % 15
+        self.artists = [StubArtist(self.id // 100, fetch=False)]
+
+    def image(self):
+        return f"https://resources.tidal.com/images/{self.id}.jpg"
+
+    def tracks(self):
+        count_call()
+        return [StubTrack(self.id * 100 + i, 1 + i // 10) for i in range(self.num_tracks)]
+
+
+class StubArtist:
+    def __init__(self, id, fetch=True, name=None):
+        self.id = int(id)
+        self.name = name or stub_name(self.id)
+        self.listen_url = f"https://listen.tidal.com/artist/{self.id}"
+        if fetch:
+            count_call()
+
+    def image(self):
+        return f"https://resources.tidal.com/images/{self.id}.jpg"
+
+    def get_top_tracks(self, limit=None):
+        count_call()
+        return [StubAlbum(self.id * 100 + i) for i in range(min(limit or 10, 10))]
+
+    def get_albums(self, limit=None):
+        count_call()
+        return [StubAlbum(self.id * 100 + i) for i in range(0, min(limit or 12, 12))]
+
+    def get_ep_singles(self, limit=None):
+        count_call()
+        return [StubAlbum(self.id * 100 + i) for i in range(12, 12 + min(limit or 6, 6))]
+
+
+class StubSession:
+    """Stands in for tidalapi.Session."""
+
+    token_type = access_token = refresh_token = expiry_time = None
+
+    def search(self, query, offset=0, limit=50, models=None):
+        count_call()
+        id = zlib.crc32(query.encode()) % 1000000
+        return {
+            "artists": [StubArtist(id, fetch=False, name=query)] if offset == 0 else [],
+            "albums": [StubAlbum(id * 100)] if offset == 0 else [],
+        }
+
+    def artist(self, id):
+        return StubArtist(id)
+
+    def album(self, id):
+        count_call()
+        return StubAlbum(id)
+
+
+class StubUpstream(BaseHTTPRequestHandler):
+    """Answers for api.musicinfo.pro, the Lidarr library and Last.fm."""
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/api/v1/artist":
+            body = [{"artistName": stub_name(i)} for i in range(1000)]
+        elif "/artist/" in path:
+            mbid = path.split("/")[-1]
+            body = {"id": mbid, "artistname": stub_name(mbid[:8])}
+        elif "/search" in path:
+            body = []
+        else:
+            body = {}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stubs():
+    """Starts the stub upstream server and points the service and its Tidal sessions at the stubs."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstream)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    workdir = tempfile.mkdtemp(prefix="lidarr-tidal-replay-")
+    os.environ["LIDARR_URL"] = url
+    os.environ["LIDARR_API_KEY"] = "replay"
+    os.environ["SESSION_CONFIG_FILE"] = os.path.join(workdir, "session.ini")
+    os.environ["CACHE_FILE"] = os.path.join(workdir, "cache.sqlite")
+    os.environ["ARTIST_CACHE_FILE"] = os.path.join(workdir, "artists.sqlite")
+
+    import sessions
+
+    def stub_login(self):
+        self.session = StubSession()
+    sessions.TidalSession._login = stub_login
+
+    import requests_cache
+    import index
+    import lidarr
+    # Stubs answer instantly, don't let the HTTP cache hide the service's own work
+    requests_cache.uninstall_cache()
+    index.lidarr_api_url = url
+    index.scrobbler_api_url = url
+    lidarr.lidarr_api_url = url
+    return index.app
+
+
+############################################
+## Replay
+############################################
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def endpoint(path: str) -> str:
+    for name in ("search", "artist", "album"):
+        if f"/{name}" in path:
+            return name
+    return "other"
+
+
+def replay(app, entries: list, speed: float, concurrency: int) -> list:
+    """
+    Sends the captured requests to the app, keeping their relative timing divided by `speed`
+    (0 sends them as fast as possible).
+
+    Latency is measured from the time the capture schedules a request, so time spent
+    waiting for a free worker counts. With speed 0, all requests are scheduled at the start
+    and latency mostly reflects the position in the queue: service time, from the moment
+    a worker picks a request up, shows how long the service itself took.
+
+    Returns:
+    A list of (entry, status, latency in ms, Tidal calls, queue delay in ms) tuples.
+    """
+    results = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(entry, scheduled):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        calls.count = 0
+        start = time.perf_counter()
+        try:
+            response = local.client.open(entry["path"], method=entry["method"], data=entry.get("body"),
+                                         headers={"X-Proxy-Host": entry["host"]})
+            status = response.status_code
+        except Exception as e:
+            print(f"Error replaying {entry['path']}: {e}")
+            status = None
+        latency = (time.perf_counter() - scheduled) * 1000
+        with lock:
+            results.append((entry, status, latency, calls.count, (start - scheduled) * 1000))
+
+    # Captured times are absolute, replay them relative to the first request
+    first = entries[0]["t"] if entries else 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for entry in entries:
+            scheduled = started + (entry["t"] - first) / speed if speed else started
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, entry, scheduled)
+    return results
+
+
+def report(results: list, elapsed: float) -> None:
+    latencies = [r[2] for r in results]
+    queue_delays = [r[4] for r in results]
+    service_times = [r[2] - r[4] for r in results]
+    errors = [r for r in results if r[1] is None or r[1] >= 500]
+    statuses = Counter(str(r[1]) for r in results)
+    tidal_calls = [r[3] for r in results]
+
+    print(f"Requests:    {len(results)} in {elapsed:.2f}s ({len(results) / elapsed if elapsed else 0:.1f} req/s)")
+    print(f"Latency ms:  p50={percentile(latencies, 50):.1f} p90={percentile(latencies, 90):.1f} "
+          f"p99={percentile(latencies, 99):.1f} max={max(latencies, default=0):.1f}")
+    print(f"Queued ms:   p50={percentile(queue_delays, 50):.1f} p90={percentile(queue_delays, 90):.1f} "
+          f"p99={percentile(queue_delays, 99):.1f} max={max(queue_delays, default=0):.1f}")
+    print(f"Service ms:  p50={percentile(service_times, 50):.1f} p90={percentile(service_times, 90):.1f} "
+          f"p99={percentile(service_times, 99):.1f} max={max(service_times, default=0):.1f}")
+    print(f"Errors:      {len(errors)} ({100 * len(errors) / len(results) if results else 0:.1f}%)")
+    print(f"Status:      {', '.join(f'{s}={n}' for s, n in sorted(statuses.items()))}")
+    print(f"Tidal calls: {sum(tidal_calls)} ({sum(tidal_calls) / len(results) if results else 0:.2f} per request)")
+    for name in ("search", "artist", "album", "other"):
+        matching = [r for r in results if endpoint(r[0]["path"]) == name]
+        if matching:
+            per_request = [r[3] for r in matching]
+            print(f"  {name:<7} {len(matching):>6} requests, {sum(per_request) / len(matching):.2f} Tidal calls "
+                  f"per request (max {max(per_request)}), service p50={percentile([r[2] - r[4] for r in matching], 50):.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a capture of Lidarr requests against the service.")
+    parser.add_argument("capture", help="Capture file written by http-redirect-request.py (CAPTURE_FILE)")
+    parser.add_argument("--speed", default="1",
+                        help="Replay speed relative to the capture, e.g. 1 or 10, or 'max' for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8, help="Maximum number of requests in flight")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the service while replaying")
+    args = parser.parse_args()
+
+    speed = 0 if args.speed == "max" else float(args.speed.rstrip("x"))
+    with open(args.capture) as f:
+        entries = sorted((json.loads(line) for line in f if line.strip()), key=lambda e: e["t"])
+    if not entries:
+        sys.exit(f"No requests in {args.capture}")
+
+    app = start_stubs()
+    print(f"Replaying {len(entries)} requests " + ("as fast as possible" if not speed else f"at {speed:g}x speed"))
+    started = time.perf_counter()
+    if args.verbose:
+        results = replay(app, entries, speed, args.concurrency)
+    else:
+        logging.getLogger().setLevel(logging.WARNING)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            results = replay(app, entries, speed, args.concurrency)
+    report(results, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import threading
+import time
+
+import requests
+
+
+NOT_FOUND = "not_found"
+REGION_LOCKED = "region_locked"
+RATE_LIMITED = "rate_limited"
+AUTH = "auth"
+TRANSIENT = "transient"
+UNEXPECTED = "unexpected"
+
+
+class TidalUnavailable(Exception):
+    """Raised instead of calling Tidal when the answer is already known to be a failure."""
+
+    def __init__(self, kind: str, message: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_error(e: Exception) -> str:
+    """
+    Classifies an exception raised while talking to Tidal.
+
+    Args:
+        e: The exception raised by tidalapi or requests.
+
+    Returns:
+        One of NOT_FOUND, REGION_LOCKED, RATE_LIMITED, AUTH, TRANSIENT or UNEXPECTED.
+    """
+    if isinstance(e, TidalUnavailable):
+        return e.kind
+
+    # Newer tidalapi versions raise their own exceptions instead of HTTPError
+    name = type(e).__name__
+    if name == "ObjectNotFound":
+        return NOT_FOUND
+    if name == "MetadataNotAvailable":
+        return REGION_LOCKED
+    if name == "TooManyRequests":
+        return RATE_LIMITED
+    if name in ("AuthenticationError", "AuthorizationError"):
+        return AUTH
+
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        if status == 404:
+            return NOT_FOUND
+        if status == 403:  # What Tidal answers for items not available in the account's country
+            return REGION_LOCKED
+        if status == 429:
+            return RATE_LIMITED
+        if status == 401:
+            return AUTH
+        if status >= 500:
+            return TRANSIENT
+        return UNEXPECTED
+
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return TRANSIENT
+    return UNEXPECTED
+
+
+def retry_after(e: Exception) -> int:
+    """Returns the Retry-After hint (in seconds) of a rate-limited response, or 0."""
+    value = getattr(e, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        value = headers.get("Retry-After")
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class NegativeCache:
+    """Remembers IDs Tidal reported as missing or unavailable, so they are not requested again until the TTL expires."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._expiry = {}
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, id: str) -> None:
+        with self._lock:
+            self._expiry[(kind, str(id))] = time.monotonic() + self.ttl
+
+    def contains(self, kind: str, id: str) -> bool:
+        key = (kind, str(id))
+        with self._lock:
+            expiry = self._expiry.get(key)
+            if expiry is None:
+                return False
+            if expiry <= time.monotonic():
+                del self._expiry[key]
+                return False
+            return True
+
+    def state(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, v in self._expiry.items() if v <= now]:
+                del self._expiry[key]
+            return {"ttl": self.ttl, "entries": len(self._expiry)}
+
+
+class CircuitBreaker:
+    """
+    Fails fast for a cooling-off period after repeated rate-limit, auth or server errors.
+
+    The breaker is "closed" while calls go through, "open" while they are
+    rejected and "half_open" once the cooldown has passed: a single call is
+    then let through as a probe, all others are still rejected until the
+    probe's outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, threshold: int, cooldown: int):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_until = 0.0
+        self._probing = False
+        self._last_error = None
+        self._lock = threading.Lock()
+
+    def _available(self) -> bool:
+        if self._opened_until > time.monotonic():
+            return False
+        return self._failures < self.threshold or not self._probing
+
+    def available(self) -> bool:
+        """Returns True if a call would currently be let through, without claiming the half-open probe."""
+        with self._lock:
+            return self._available()
+
+    def allow(self) -> bool:
+        """Returns True if a call may go through. In half-open state, only the first caller gets True."""
+        with self._lock:
+            if not self._available():
+                return False
+            if self._failures >= self.threshold:
+                self._probing = True
+            return True
+
+    def remaining(self) -> int:
+        with self._lock:
+            return max(int(self._opened_until - time.monotonic()), 0)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_until = 0.0
+            self._probing = False
+
+    def record_failure(self, kind: str, cooldown: int = 0) -> None:
+        with self._lock:
+            self._failures += 1
+            self._last_error = kind
+            self._probing = False
+            if self._failures >= self.threshold:
+                self._opened_until = time.monotonic() + max(self.cooldown, cooldown)
+
+    def trip(self, kind: str, cooldown: int = 0) -> None:
+        """Opens the breaker right away, e.g. when Tidal asked to back off."""
+        with self._lock:
+            self._failures = max(self._failures + 1, self.threshold)
+            self._last_error = kind
+            self._probing = False
+            self._opened_until = time.monotonic() + max(self.cooldown, cooldown)
+
+    def release(self) -> None:
+        """Lets another probe through, for calls whose outcome says nothing about Tidal's health."""
+        with self._lock:
+            self._probing = False
+
+    def state(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            if self._opened_until > now:
+                state = "open"
+            elif self._failures >= self.threshold:
+                state = "half_open"
+            else:
+                state = "closed"
+            return {
+                "state": state,
+                "failures": self._failures,
+                "threshold": self.threshold,
+                "cooldown": self.cooldown,
+                "retry_in": max(int(self._opened_until - now), 0),
+                "probing": self._probing,
+                "last_error": self._last_error,
+            }
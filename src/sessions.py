@@ -0,0 +1,181 @@
+import datetime
+import itertools
+import os
+import threading
+from configparser import ConfigParser
+from contextlib import contextmanager
+
+import tidalapi
+
+from resilience import RATE_LIMITED, REGION_LOCKED, TidalUnavailable, CircuitBreaker, NegativeCache
+
+
+class TidalSession:
+    """
+    A logged in Tidal account, with its own session file, token refresh and
+    rate-limit state, and the items that are not available in its country.
+    """
+
+    def __init__(self, path: str, breaker: CircuitBreaker, unavailable: NegativeCache):
+        self.path = path
+        self.breaker = breaker
+        self.unavailable = unavailable
+        self.session = tidalapi.Session()
+        self.in_flight = 0
+        self.calls = 0
+        self._saved_token = None
+        self._lock = threading.Lock()
+        self._login()
+
+    def _login(self):
+        # If session file exists, use that
+        if os.path.isfile(self.path):
+            config = ConfigParser()
+            config.read([self.path])
+            try:
+                self.session.load_oauth_session(
+                    config['session']['token_type'],
+                    config['session']['access_token'],
+                    config['session'].get('refresh_token', None),
+                    parse_expiry_time(config['session'].get('expiry_time', None))
+                )
+            except KeyError:
+                print(f'supplied configuration to restore session {self.path} is incomplete')
+            else:
+                self._saved_token = self.session.access_token
+                if not self.session.check_login():
+                    print(f'loaded session {self.path} appears to be not authenticated')
+
+        if not self.session.check_login():
+            print(f'authenticating new session {self.path}')
+            self.session.login_oauth_simple()
+            self.save()
+
+    def save(self):
+        """Writes the current tokens to the session file."""
+        config = ConfigParser()
+        config['session'] = {
+            'token_type': self.session.token_type,
+            'access_token': self.session.access_token,
+            'refresh_token': self.session.refresh_token,
+            'expiry_time': self.session.expiry_time
+        }
+        with open(self.path, 'w') as configfile:
+            config.write(configfile)
+        self._saved_token = self.session.access_token
+
+    def refresh_token(self):
+        """Refreshes the access token shortly before it expires, and saves tokens refreshed by tidalapi itself."""
+        with self._lock:
+            expiry_time = self.session.expiry_time
+            if (isinstance(expiry_time, datetime.datetime) and self.session.refresh_token
+                    and expiry_time <= datetime.datetime.utcnow() + datetime.timedelta(minutes=1)):
+                print(f'refreshing access token of session {self.path}')
+                try:
+                    self.session.token_refresh(self.session.refresh_token)
+                except Exception as e:
+                    print(f'Error refreshing access token of session {self.path}: {e}')
+            if self.session.access_token != self._saved_token:
+                try:
+                    self.save()
+                except Exception as e:
+                    print(f'Error saving session {self.path}: {e}')
+                    # Keep using the token, the next refresh tries to save again
+                    self._saved_token = self.session.access_token
+
+    def state(self) -> dict:
+        return {
+            "path": self.path,
+            "in_flight": self.in_flight,
+            "calls": self.calls,
+            "circuit_breaker": self.breaker.state(),
+            "unavailable_cache": self.unavailable.state(),
+        }
+
+
+class SessionPool:
+    """
+    Spreads Tidal calls across several accounts.
+
+    Sessions whose circuit breaker is open are skipped until their cooldown
+    has passed, as are sessions for which the requested item is region-locked.
+    Of the remaining sessions, "least_loaded" picks the one with
+    the fewest calls in progress, "round_robin" takes turns.
+    """
+
+    def __init__(self, sessions: list, scheduling: str = 'least_loaded'):
+        if scheduling not in ('least_loaded', 'round_robin'):
+            raise ValueError(f"unknown session scheduling '{scheduling}'")
+        self.sessions = sessions
+        self.scheduling = scheduling
+        self._turns = itertools.cycle(range(len(sessions)))
+        self._lock = threading.Lock()
+
+    def _eligible(self, kind: str, id) -> list:
+        """Returns the sessions for which the item is not known to be region-locked."""
+        return [s for s in self.sessions if id is None or not s.unavailable.contains(kind, id)]
+
+    def available(self, kind: str = None, id=None) -> bool:
+        """Returns True if a session that can get the item would currently let a call through."""
+        return any(s.breaker.available() for s in self._eligible(kind, id))
+
+    def remaining(self, kind: str = None, id=None) -> int:
+        """Returns the seconds until the first session that can get the item has cooled off."""
+        return min((s.breaker.remaining() for s in self._eligible(kind, id)), default=0)
+
+    def unavailable(self, kind: str, id) -> bool:
+        """Returns True if the item is region-locked for every session."""
+        return id is not None and all(s.unavailable.contains(kind, id) for s in self.sessions)
+
+    def _pick(self, kind: str, id) -> TidalSession:
+        with self._lock:
+            sessions = self._eligible(kind, id)
+            if not sessions:
+                raise TidalUnavailable(REGION_LOCKED, f"{kind} {id} is not available to any session")
+            if self.scheduling == 'round_robin':
+                for _ in range(len(self.sessions)):
+                    s = self.sessions[next(self._turns)]
+                    if s in sessions and s.breaker.allow():
+                        break
+                else:
+                    s = None
+            else:
+                candidates = sorted(sessions, key=lambda c: (c.in_flight, c.calls))
+                s = next((c for c in candidates if c.breaker.allow()), None)
+            if s is None:
+                raise TidalUnavailable(RATE_LIMITED, f"circuit breaker open for all sessions for {self.remaining(kind, id)}s")
+            s.in_flight += 1
+            s.calls += 1
+            return s
+
+    @contextmanager
+    def acquire(self, kind: str = None, id=None):
+        """Picks a session for the duration of a call to Tidal about an item."""
+        s = self._pick(kind, id)
+        try:
+            try:
+                s.refresh_token()
+            except Exception:
+                # Tidal was not called, let the next caller probe the session
+                s.breaker.release()
+                raise
+            yield s
+        finally:
+            with self._lock:
+                s.in_flight -= 1
+
+    def state(self) -> dict:
+        return {
+            "scheduling": self.scheduling,
+            "sessions": [s.state() for s in self.sessions],
+        }
+
+
+def parse_expiry_time(value):
+    """Parses the expiry time stored in a session file, which is written as str(datetime)."""
+    if not value or value == 'None':
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
@@ -4,12 +4,19 @@ from requests.exceptions import JSONDecodeError as requestsJSONDecodeError
 from json import JSONDecodeError
 import os
 import tidalapi
-from configparser import ConfigParser
+from contextlib import contextmanager
 from datetime import timedelta
 import logging
 
-from helpers import title_case, normalize, remove_keys, fake_id, get_type, convert_date_format
-from lidarr import get_all_lidarr_artists
+from helpers import title_case, remove_keys, fake_id, get_type, convert_date_format, canonical_id
+from lidarr import get_lidarr_library_index
+from matching import same_name, rank, best_match
+import artist_store
+from resilience import (
+    NOT_FOUND, REGION_LOCKED, RATE_LIMITED, AUTH, TRANSIENT,
+    TidalUnavailable, NegativeCache, CircuitBreaker, classify_error, retry_after,
+)
+from sessions import TidalSession, SessionPool
 
 logging.basicConfig(level='DEBUG')
 # Cache HTTP requests for 1 minute
@@ -31,42 +38,100 @@ requests_cache.install_cache(cache_name=os.environ.get('CACHE_FILE'),
                              allowable_methods=('GET'))
 
 ############################################
-## Establish Tidal session
+## Establish Tidal sessions
 ############################################
 
-session_path = os.environ.get('SESSION_CONFIG_FILE')
-session = tidalapi.Session()
+# Albums/artists Tidal reports as missing or region-locked are not requested again for a day
+not_found_ttl = int(os.environ.get('NOT_FOUND_TTL', 60 * 60 * 24))
 
-# If session file exists, use that
-if os.path.isfile(session_path):
-    config = ConfigParser()
-    config.read([session_path])
+# Stop calling Tidal with a session for a while after a 429, or repeated 5xx/auth errors
+def session_breaker():
+    return CircuitBreaker(threshold=int(os.environ.get('CIRCUIT_BREAKER_THRESHOLD', 5)),
+                          cooldown=int(os.environ.get('CIRCUIT_BREAKER_COOLDOWN', 60 * 5)))
+
+# Several session files (one per Tidal account) can be given, separated by commas
+session_paths = [p.strip() for p in os.environ.get('SESSION_CONFIG_FILE').split(',') if p.strip()]
+pool = SessionPool([TidalSession(p, session_breaker(), NegativeCache(ttl=not_found_ttl)) for p in session_paths],
+                   scheduling=os.environ.get('SESSION_SCHEDULING', 'least_loaded'))
+
+
+############################################
+## Failure handling
+############################################
+
+# Removed albums/artists are missing for every session, region-locked ones are tracked per session
+not_found = NegativeCache(ttl=not_found_ttl)
+
+
+@contextmanager
+def tidal_session(kind: str, id=None):
+    """
+    Provides a Tidal session for one lookup, and records its outcome.
+
+    Raises TidalUnavailable without hitting Tidal if the item is cached as not
+    found (or region-locked for every session) or all sessions are cooling off.
+    Failures are classified and update the negative caches and the circuit
+    breaker of the session that was used. A rate-limited session is taken out
+    of rotation right away.
+    """
+    if id is not None and not_found.contains(kind, id):
+        raise TidalUnavailable(NOT_FOUND, f"{kind} {id} is cached as not found")
+
+    with pool.acquire(kind, id) as s:
+        try:
+            yield s.session
+        except Exception as e:
+            error = classify_error(e)
+            if error in (NOT_FOUND, REGION_LOCKED):
+                if id is not None:
+                    (not_found if error == NOT_FOUND else s.unavailable).add(kind, id)
+                # Tidal answered, so the session works
+                s.breaker.record_success()
+            elif error == RATE_LIMITED:
+                s.breaker.trip(error, cooldown=retry_after(e))
+            elif error in (AUTH, TRANSIENT):
+                s.breaker.record_failure(error, cooldown=retry_after(e))
+            else:
+                s.breaker.release()
+            raise
+        else:
+            s.breaker.record_success()
+
+
+def tidal_call(kind: str, id, fetch):
+    """
+    Runs fetch(session) with a session from the pool and returns its result.
+
+    If Tidal rate-limited the session, the call is repeated once: the session
+    was just taken out of rotation, so another one is used if any is available.
+    """
     try:
-        session.load_oauth_session(
-            config['session']['token_type'],
-            config['session']['access_token'],
-            config['session'].get('refresh_token', None),
-            config['session'].get('expiry_time', None)
-        )
-    except KeyError:
-        print('supplied configuration to restore session is incomplete')
-    else:
-        if not session.check_login():
-            print('loaded session appears to be not authenticated')
-
-
-if not session.check_login():
-    print('authenticating new session')
-    session.login_oauth_simple()
-    config = ConfigParser()
-    config['session'] = {
-        'token_type': session.token_type,
-        'access_token': session.access_token,
-        'refresh_token': session.refresh_token,
-        'expiry_time': session.expiry_time
+        with tidal_session(kind, id) as session:
+            return fetch(session)
+    except Exception as e:
+        if isinstance(e, TidalUnavailable) or classify_error(e) != RATE_LIMITED:
+            raise
+        print(f"Rate-limited while retrieving {kind} {id}, retrying with another session: {e}")
+    with tidal_session(kind, id) as session:
+        return fetch(session)
+
+
+def failure_status(kind: str, id) -> int:
+    """Returns the HTTP status code to answer with when a Tidal lookup came back empty."""
+    if not_found.contains(kind, id) or pool.unavailable(kind, id):
+        return 404
+    if not pool.available(kind, id):
+        return 503
+    # 502 because the item most likely exists, might be running into rate limit
+    return 502
+
+
+def tidal_status() -> dict:
+    return {
+        "session_pool": pool.state(),
+        "not_found_cache": not_found.state(),
+        "artist_store": artist_store.store_status(),
     }
-    with open(session_path, 'w') as configfile:
-        config.write(configfile)
 
 
 def to_dict(obj, level=0):
@@ -142,74 +207,125 @@ def filter_items(items):
 ############################################
 
 def search_artists(query, offset, limit):
-    try:
+    def fetch(session):
         search_results = session.search(query=query, offset=offset, limit=limit, models=[tidalapi.artist.Artist])["artists"]
         dicts = [to_dict(a) for a in search_results]
         for i, a in enumerate(dicts):
             a["picture_xl"] = search_results[i].image()
+        return dicts
+    try:
+        dicts = tidal_call("search", None, fetch)
     except (Exception, TypeError) as e:
-        print(f"Error for search artists {query}: {e}")
+        print(f"Error ({classify_error(e)}) for search artists {query}: {e}")
         dicts = []
     return { "data": dicts }
 
 def search_albums(query, offset, limit):
-    try:
+    def fetch(session):
         search_results = session.search(query=query, offset=offset, limit=limit, models=[tidalapi.album.Album])["albums"]
         dicts = [to_dict(a) for a in search_results]
         for i, a in enumerate(dicts):
             a["cover_xl"] = search_results[i].image()
+        return dicts
+    try:
+        dicts = tidal_call("search", None, fetch)
     except (Exception, TypeError) as e:
-        print(f"Error for search albums {query}: {e}")
+        print(f"Error ({classify_error(e)}) for search albums {query}: {e}")
         dicts = []
     return { "data": dicts }
 
 def album(album_id):
-    try:
+    def fetch(session):
         album = session.album(album_id)
         album_dict = to_dict(album)
         album_dict['cover_xl'] = album.image()
+        return album_dict
+    try:
+        album_dict = tidal_call("album", album_id, fetch)
     except (Exception, TypeError) as e:
-        print(f"Error retrieving album {album_id}: {e}")
+        print(f"Error ({classify_error(e)}) retrieving album {album_id}: {e}")
         album_dict = {}
     return { "data": album_dict }
 
+# Number of albums (and of EPs/singles) fetched to check whether a discography changed
+fingerprint_page_size = int(os.environ.get('FINGERPRINT_PAGE_SIZE', 50))
+
 def artist(artist_id):
-    try:
+    def fetch(session):
         artist = session.artist(artist_id)
         artist_dict = to_dict(artist)
         artist_dict['picture_xl'] = artist.image()
         artist_dict['top'] = filter_items(artist.get_top_tracks(limit=100))
-        artist_dict['albums'] = filter_items(artist.get_albums(limit=200))
-        artist_dict['albums'].extend(filter_items(artist.get_ep_singles(limit=200)))
+        albums = artist.get_albums(limit=200)
+        ep_singles = artist.get_ep_singles(limit=200)
+        artist_dict['albums'] = filter_items(albums)
+        artist_dict['albums'].extend(filter_items(ep_singles))
+        # Same as artist_fingerprint() would return, without fetching the first pages again
+        artist_dict['fingerprint'] = fingerprint(albums[:fingerprint_page_size] + ep_singles[:fingerprint_page_size])
+        return artist_dict
+    try:
+        artist_dict = tidal_call("artist", artist_id, fetch)
     except (Exception, TypeError) as e:
-        print(f"Error retrieving artist {artist_id}: {e}")
+        print(f"Error ({classify_error(e)}) retrieving artist {artist_id}: {e}")
         artist_dict = {}
 
     return {"data": artist_dict}
 
+def fingerprint(albums) -> dict:
+    """Summarizes a list of albums, to detect changes in a discography."""
+    release_dates = [a.release_date for a in albums if a.release_date is not None]
+    return {
+        "albums": sorted([a.id, a.num_tracks] for a in albums),
+        "count": len(albums),
+        "latest_release": convert_date_format(max(release_dates)) if release_dates else None,
+    }
+
+def artist_fingerprint(artist_id):
+    """
+    Fetches the first page of an artist's albums and EPs/singles and summarizes it,
+    so an unchanged discography can be detected without fetching everything.
+
+    Raises the error of the failed Tidal call, so the caller can decide whether
+    its stored artist is still worth serving.
+    """
+    def fetch(session):
+        artist = session.artist(artist_id)
+        albums = artist.get_albums(limit=fingerprint_page_size)
+        albums.extend(artist.get_ep_singles(limit=fingerprint_page_size))
+        return albums
+
+    return fingerprint(tidal_call("artist", artist_id, fetch))
+
 def artist_top(artist_id):
-    try:
+    def fetch(session):
         artist = session.artist(artist_id)
-        return { "data": filter_items(artist.get_top_tracks(limit=100))}
+        return filter_items(artist.get_top_tracks(limit=100))
+    try:
+        return { "data": tidal_call("artist", artist_id, fetch) }
     except (Exception, TypeError) as e:
-        print(f"Error retrieving top for artist {artist_id}: {e}")
+        print(f"Error ({classify_error(e)}) retrieving top for artist {artist_id}: {e}")
         return { "data": [] }
 
 def album_tracks(album_id):
-    try:
+    def fetch(session):
         album = session.album(album_id)
-        return { "data": to_dict(album.tracks()) }
+        return to_dict(album.tracks())
+    try:
+        return { "data": tidal_call("album", album_id, fetch) }
     except (Exception, TypeError) as e:
-        print(f"Error retrieving tracks for album {album_id}: {e}")
+        print(f"Error ({classify_error(e)}) retrieving tracks for album {album_id}: {e}")
         return { "data": [] }
 
 def artist_albums(artist_id):
-    try:
+    def fetch(session):
         artist = session.artist(artist_id)
         albums_dict = filter_items(artist.get_albums(limit=20))
         albums_dict.extend(filter_items(artist.get_ep_singles(limit=200)))
+        return albums_dict
+    try:
+        albums_dict = tidal_call("artist", artist_id, fetch)
     except (Exception, TypeError) as e:
-        print(f"Error retrieving albums for artist {artist_id}: {e}")
+        print(f"Error ({classify_error(e)}) retrieving albums for artist {artist_id}: {e}")
         albums_dict = []
     return { "data": albums_dict }
 
@@ -262,10 +378,29 @@ def tidal_tracks(id: str) -> list:
 
 def tidal_artist(id: str) -> dict:
     print(f"Fetching artist from Tidal for id: {id}")
+    stored = artist_store.load_artist(id)
+    probed = None
+    # Only probe when there is something to compare with, otherwise the full fetch below provides the fingerprint
+    if stored is not None:
+        try:
+            probed = artist_fingerprint(id)
+        except (Exception, TypeError) as e:
+            error = classify_error(e)
+            print(f"Error ({error}) retrieving fingerprint for artist {id}: {e}")
+            if error in (RATE_LIMITED, AUTH, TRANSIENT):
+                # The full fetch would run into the same failure, the stored artist is better than nothing
+                print(f"Using stored artist {id} while Tidal is unavailable")
+                return stored["payload"]
+    if probed is not None and stored["fingerprint"] == probed:
+        print(f"Discography of artist {id} unchanged, using stored artist and albums")
+        return stored["payload"]
+
     data = artist(id)
     j = data['data']
+    if not j:
+        return None
 
-    return {
+    payload = {
         "Albums": [
             {
                 "Id": fake_id(a["id"], "album"),
@@ -295,13 +430,28 @@ def tidal_artist(id: str) -> dict:
         "type": "Artist",
     }
 
+    new_fingerprint = probed if probed is not None else j["fingerprint"]
+    if stored is not None:
+        # Discography changed, fetch the albums that were removed or whose tracks changed again
+        old_tracks = {canonical_id(a): n for a, n in stored["fingerprint"]["albums"]}
+        new_tracks = {canonical_id(a): n for a, n in new_fingerprint["albums"]}
+        current = {canonical_id(a["id"]) for a in j["albums"]}
+        changed = [
+            a for a in map(canonical_id, stored["album_ids"])
+            if a not in current or (a in old_tracks and a in new_tracks and old_tracks[a] != new_tracks[a])
+        ]
+        forgotten = artist_store.forget_albums(changed)
+        print(f"Discography of artist {id} changed, dropped {forgotten} stored albums")
+    artist_store.save_artist(id, new_fingerprint, payload, [a["id"] for a in j["albums"]])
+    return payload
+
 def tidal_albums(name: str) -> list:
     total = 0
     start = 0
 
-    print(f"Fetching artist from Tidal for id: {id}")
+    print(f"Searching albums in Tidal with name: {name}")
     response = search_albums(query=name, offset=0, limit=1)
-    total = len(j["data"])
+    total = len(response["data"])
 
     albums = []
     while start < total:
@@ -310,9 +460,21 @@ def tidal_albums(name: str) -> list:
         albums.extend(response["data"])
         start += 100
 
-    return [a for a in albums if normalize(a["artist"]["name"]) == normalize(name) or a["artist"]["name"] == "Verschillende artiesten"]
+    return [a for a in albums if same_name(a["artist"]["name"], name) or a["artist"]["name"] == "Verschillende artiesten"]
 
 def get_album(id: str):
+    stored = artist_store.load_album(id)
+    if stored is not None:
+        print(f"Using stored album for id: {id}")
+        return stored
+
+    payload = build_album(id)
+    # Albums attributed to a contributor that is not in the library are not stored, the artist might be added later
+    if payload is not None and get_lidarr_library_index().lookup(payload["artists"][0]["artistname"]) is not None:
+        artist_store.save_album(id, payload)
+    return payload
+
+def build_album(id: str):
     d = tidal_album(id)
     if not d or not d.get('artists', None):
         return None
@@ -335,14 +497,14 @@ def get_album(id: str):
         for c in d["artists"]
     ]
 
-    lidarr_artists = get_all_lidarr_artists()
+    # Attribute the album to the first contributor that is in the Lidarr library
+    def in_library(library):
+        return next((c for c in contributors if library.lookup(c["artistname"]) is not None), None)
 
-    tidal = None
-    for la in lidarr_artists:
-        for c in contributors:
-            if la["artistName"] == c["artistname"] or normalize(la["artistName"]) == normalize(c["artistname"]):
-                tidal = c
-                break
+    tidal = in_library(get_lidarr_library_index())
+    if tidal is None:
+        # The artist may have just been added to Lidarr
+        tidal = in_library(get_lidarr_library_index(refresh=True)) or contributors[0]
 
     lidarr2 = {
         "id": tidal["id"],
@@ -455,30 +617,23 @@ def search(query):
                 "oldids": [],
                 "overview": "",
             },
-            "score": 100,
+            "score": 0,
         }
         for d in tartists
     ]
 
-    sorted_artists = []
-    for a in dtolartists:
-        if (
-            a["artist"]["artistname"] == unquote(query)
-            or normalize(a["artist"]["artistname"]) == normalize(unquote(query))
-        ):
-            sorted_artists.insert(0, a)
-        else:
-            sorted_artists.append(a)
-    dtolartists = sorted_artists
+    ranked = rank(unquote(query), dtolartists, key=lambda a: a["artist"]["artistname"])
+    for score, a in ranked:
+        a["score"] = score
 
-    return dtolartists
+    return [a for _, a in ranked]
 
 def get_artist_by_name(name: str):
     artists = tidal_artists(name)
     if not artists:
         return None
 
-    artist = next((a for a in artists if a["name"] == name or normalize(a["name"]) == normalize(name)), None)
+    artist = best_match(name, artists, key=lambda a: a["name"])
     if artist is not None:
         return tidal_artist(artist['id'])
     return None